@@ -12,12 +12,14 @@ Todo
     *
 
 """
+import io
 import os
 import time
 import copy
+import threading
 import numpy as np
 import torch
-from collections import defaultdict
+from gymnasium.spaces import Box
 
 from safe_control_gym.utils.logging import ExperimentLogger
 from safe_control_gym.utils.utils import get_random_state, set_random_state, is_wrapped
@@ -29,7 +31,8 @@ from safe_control_gym.math_and_models.normalization import BaseNormalizer, MeanS
 
 from safe_control_gym.controllers.base_controller import BaseController
 from safe_control_gym.controllers.safe_ddpg.safe_explorer_utils import SafetyLayer, ConstraintBuffer
-from safe_control_gym.controllers.safe_ddpg.safe_ddpg_utils import SafeDDPGAgent, SafeDDPGBuffer, make_action_noise_process
+from safe_control_gym.controllers.safe_ddpg.safe_ddpg_utils import SafeDDPGAgent, SafeDDPGBuffer, PrefetchSampler, \
+    make_action_noise_process
 
 
 class SafeExplorerDDPG(BaseController):
@@ -55,8 +58,34 @@ class SafeExplorerDDPG(BaseController):
             # action noise for training
             self.noise_process = None
             # if self.random_process:
-            #     self.noise_process = make_action_noise_process(self.random_process, self.env.action_space)
-            self.num_constraints = self.env.envs[0].num_constraints
+            #     self.noise_process = make_action_noise_process(self.random_process, self.env.action_space,
+            #                                                    num_envs=self.rollout_batch_size)
+            # query through the vec env api so both serial and subprocess envs (num_workers > 1) work
+            self.num_constraints = self.env.get_attr("num_constraints", indices=[0])[0]
+            # all sub-envs share the same action space, sample random actions in one call
+            self._rng = np.random.default_rng(seed)
+            self._act_low = self.env.action_space.low.astype(np.float32)
+            self._act_high = self.env.action_space.high.astype(np.float32)
+            self._act_shape = (self.rollout_batch_size,) + self._act_low.shape
+            # uniform sampling needs finite bounds, otherwise fall back to the action space sampler
+            self._act_bounded = np.all(np.isfinite(self._act_low)) and np.all(np.isfinite(self._act_high))
+            if not self._act_bounded:
+                self.env.action_space.seed(seed)
+            # array observations can skip the (un)flattening needed for dict observations
+            self._is_box_obs = isinstance(self.env.observation_space, Box)
+            # constraint values gathered by the env wrapper into a preallocated array
+            self.env.add_info_buffer("constraint_values", (self.num_constraints,))
+            # preallocated constraint values (current and next) for the vectorized env
+            self._c_buf = np.empty((self.rollout_batch_size, self.num_constraints), dtype=np.float32)
+            self._c_next_buf = np.empty_like(self._c_buf)
+            # preallocated transition mask, refilled in place every step
+            self._mask_buf = np.empty(self.rollout_batch_size, dtype=np.float32)
+            # pinned staging tensors for asynchronous host-to-device copies of rollout inputs
+            self._obs_pinned, self._c_pinned = None, None
+            if self.device == "cuda":
+                obs_shape = (self.rollout_batch_size,) + self.env.observation_space.shape
+                self._obs_pinned = torch.empty(obs_shape, dtype=torch.float32, pin_memory=True)
+                self._c_pinned = torch.empty(self._c_buf.shape, dtype=torch.float32, pin_memory=True)
         else:
             # testing only
             self.env = env_func()
@@ -80,6 +109,23 @@ class SafeExplorerDDPG(BaseController):
                                critic_lr=self.critic_lr,
                                action_modifier=self.safety_layer.get_safe_action)
         self.agent.to(self.device)
+        # compile the policy network in place (keeps state dict keys), the safety layer
+        # projection stays eager since it has data-dependent python control flow
+        if self.compile_actor:
+            if not hasattr(torch.nn.Module, "compile"):
+                raise ValueError("compile_actor requires torch >= 2.2 (nn.Module.compile), found torch {}.".format(
+                    torch.__version__))
+            self.agent.ac.actor.net.compile()
+        # side stream for agent updates on cuda
+        self._update_stream = torch.cuda.Stream() if self.device == "cuda" else None
+        # prefetching only pays off when batches go to cuda, on cpu it is slower than inline sampling
+        self._prefetch_stream = None
+        if self.prefetch_depth and self.device == "cuda":
+            self._prefetch_stream = torch.cuda.Stream()
+        self._prefetcher = None
+        # background writer of the last intermediate checkpoint (and the error it hit, if any)
+        self._save_thread = None
+        self._save_error = None
 
         # pre-/post-processing
         self.obs_normalizer = BaseNormalizer()
@@ -111,7 +157,8 @@ class SafeExplorerDDPG(BaseController):
                 assert self.pretrained, "Must provide a pre-trained model for adaptation."
                 if os.path.isdir(self.pretrained):
                     self.pretrained = os.path.join(self.pretrained, "model_latest.pt")
-                state = torch.load(self.pretrained)
+                # checkpoints written by `save` hold numpy state (obs, rng states), not only tensors
+                state = torch.load(self.pretrained, weights_only=False)
                 self.safety_layer.load_state_dict(state["safety_layer"])
                 # Set up stats tracking.
                 self.env.add_tracker("constraint_violation", 0)
@@ -121,9 +168,16 @@ class SafeExplorerDDPG(BaseController):
             self.total_steps = 0
             obs, info = self.env.reset()
             self.obs = self.obs_normalizer(obs)
-            self.c = np.array([inf["constraint_values"] for inf in info["n"]])
+            self.c = self._get_constraint_values(self._c_buf)
             self.buffer = SafeDDPGBuffer(self.env.observation_space, self.env.action_space, self.max_buffer_size,
-                                     self.train_batch_size)
+                                     self.train_batch_size, store_device=self.buffer_store_device,
+                                     obs_dtype=self.buffer_obs_dtype)
+            # one long-lived worker samples ahead for all the update phases
+            if self._prefetch_stream is not None:
+                if self._prefetcher is not None:
+                    self._prefetcher.close()
+                self._prefetcher = PrefetchSampler(self.buffer, self.train_batch_size, self.device,
+                                                   depth=self.prefetch_depth, stream=self._prefetch_stream)
             # reset/initial noise process
             if self.noise_process:
                 self.noise_process.reset_states()
@@ -135,10 +189,16 @@ class SafeExplorerDDPG(BaseController):
 
     def close(self):
         """Shuts down and cleans up lingering resources."""
-        self.env.close()
-        if self.training:
-            self.eval_env.close()
-        self.logger.close()
+        try:
+            # re-raises a failed background checkpoint write, after the cleanup below
+            self._wait_for_save()
+        finally:
+            if self._prefetcher is not None:
+                self._prefetcher.close()
+            self.env.close()
+            if self.training:
+                self.eval_env.close()
+            self.logger.close()
 
     def save(self, path, save_buffer=True):
         """Saves model params and experiment state to checkpoint path."""
@@ -157,23 +217,58 @@ class SafeExplorerDDPG(BaseController):
                 "obs": self.obs,
                 "c": self.c,
                 "random_state": get_random_state(),
+                "action_rng_state": self._rng.bit_generator.state,
                 "env_random_state": self.env.get_env_random_state()
             }
             # latest checkpoint shoud enable save_buffer (for experiment restore),
             # but intermediate checkpoint shoud not, to save storage (buffer is large)
             if save_buffer:
-                exp_state["buffer"] = self.buffer.state_dict()
+                # buffer data goes to .npy files next to the checkpoint, only metadata is pickled
+                exp_state["buffer"] = self.buffer.state_dict(path)
             # noise process is also stateful
             if self.noise_process:
                 exp_state["noise_process"] = self.noise_process.state_dict()
             state_dict.update(exp_state)
             if self.pretraining:
                 state_dict["constraint_buffer"] = self.constraint_buffer.state_dict()
-        torch.save(state_dict, path)
+        self._wait_for_save()
+        if save_buffer:
+            torch.save(state_dict, path)
+        else:
+            # intermediate checkpoint, snapshot in memory now and write to disk in the background
+            data = io.BytesIO()
+            torch.save(state_dict, data)
+            self._save_thread = threading.Thread(target=self._write_checkpoint, args=(path, data))
+            self._save_thread.start()
+
+    def _write_checkpoint(self, path, data):
+        """Writes a checkpoint serialized in memory to disk.
+
+        The file is written next to `path` and then renamed, so a crash never leaves a truncated
+        checkpoint. Errors are kept and re-raised by `_wait_for_save` in the main thread.
+
+        """
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data.getbuffer())
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self._save_error = e
+
+    def _wait_for_save(self):
+        """Blocks until the pending background checkpoint write (if any) is done."""
+        if self._save_thread is not None:
+            self._save_thread.join()
+            self._save_thread = None
+            error, self._save_error = self._save_error, None
+            if error is not None:
+                raise error
 
     def load(self, path):
         """Restores model and experiment given checkpoint path."""
-        state = torch.load(path)
+        self._wait_for_save()
+        state = torch.load(path, weights_only=False)
 
         # restore params
         self.agent.load_state_dict(state["agent"])
@@ -188,9 +283,11 @@ class SafeExplorerDDPG(BaseController):
             self.obs = state["obs"]
             self.c = state["c"]
             set_random_state(state["random_state"])
+            if "action_rng_state" in state:
+                self._rng.bit_generator.state = state["action_rng_state"]
             self.env.set_env_random_state(state["env_random_state"])
             if "buffer" in state:
-                self.buffer.load_state_dict(state["buffer"])
+                self.buffer.load_state_dict(state["buffer"], path)
             if self.noise_process:
                 self.noise_process.load_state_dict(state["noise_process"])
             self.logger.load(self.total_steps)
@@ -242,6 +339,17 @@ class SafeExplorerDDPG(BaseController):
             if self.log_interval and self.total_steps % self.log_interval == 0:
                 self.log_step(results)
 
+    def select_action(self, obs, info):
+        """Determines the action to take at the current timestep.
+
+        The safety layer needs the current constraint values, so `info` is required.
+
+        """
+        with torch.no_grad():
+            action = self.agent.ac.act(self._to_device_tensor(obs),
+                                       c=self._to_device_tensor(info["constraint_values"]))
+        return action
+
     def run(self, env=None, render=False, n_episodes=10, verbose=False, **kwargs):
         """Runs evaluation with current policy."""
         self.agent.eval()
@@ -265,9 +373,7 @@ class SafeExplorerDDPG(BaseController):
 
         while len(ep_returns) < n_episodes:
             with torch.no_grad():
-                obs = torch.FloatTensor(obs).to(self.device)
-                c = torch.FloatTensor(c).to(self.device)
-                action = self.agent.ac.act(obs, c=c)
+                action = self.agent.ac.act(self._to_device_tensor(obs), c=self._to_device_tensor(c))
 
             obs, reward, done, info = env.step(action)
             if render:
@@ -300,7 +406,6 @@ class SafeExplorerDDPG(BaseController):
         """Performs a pre-trianing step.
 
         """
-        results = defaultdict(list)
         start = time.time()
         self.safety_layer.train()
         self.obs_normalizer.unset_read_only()
@@ -308,12 +413,15 @@ class SafeExplorerDDPG(BaseController):
         self.collect_constraint_data(self.constraint_steps_per_epoch)
         self.total_steps += 1
         # Do the update from memory.
+        results = self._make_constraint_loss_buffers()
+        num_batches = 0
         for batch in self.constraint_buffer.sampler(self.constraint_batch_size):
             res = self.safety_layer.update(batch)
             for k, v in res.items():
-                results[k].append(v)
+                results[k][num_batches] = v
+            num_batches += 1
         self.constraint_buffer.reset()
-        results = {k: sum(v) / len(v) for k, v in results.items()}
+        results = {k: float(v[:num_batches].mean()) for k, v in results.items() if num_batches > 0}
         results.update({"step": self.total_steps, "elapsed_time": time.time() - start})
         return results
 
@@ -329,42 +437,50 @@ class SafeExplorerDDPG(BaseController):
 
         if self.total_steps < self.warm_up_steps:
             # print(f'here 1!')
-            act = np.stack([self.env.action_space.sample() for _ in range(self.rollout_batch_size)])
+            act = self._sample_random_actions()
         else:
             # print(f'here 2!') 
             with torch.no_grad():
-                act = self.agent.ac.act(torch.FloatTensor(obs).to(self.device), 
-                                        c=torch.FloatTensor(c).to(self.device))
+                act = self.agent.ac.act(self._to_device_tensor(obs, self._obs_pinned),
+                                        c=self._to_device_tensor(c, self._c_pinned))
                 # apply action noise if specified in training config
                 if self.noise_process:
-                    noise = np.stack([self.noise_process.sample() for _ in range(self.rollout_batch_size)])
+                    noise = self.noise_process.sample()
+                    # one independent draw per env, see make_action_noise_process(num_envs=...)
+                    assert noise.shape == act.shape, "Action noise must be sampled per env, got shape {}.".format(
+                        noise.shape)
                     act += noise
         # print(f'act = {act}')
         next_obs, rew, done, info = self.env.step(act)
 
         next_obs = self.obs_normalizer(next_obs)
         rew = self.reward_normalizer(rew, done)
-        mask = 1 - np.asarray(done)
+        mask = np.logical_not(done, out=self._mask_buf)
 
         # time truncation is not true termination
-        terminal_idx, terminal_obs = [], []
-        for idx, inf in enumerate(info["n"]):
-            if "terminal_info" not in inf:
-                continue
-            inff = inf["terminal_info"]
-            if "TimeLimit.truncated" in inff and inff["TimeLimit.truncated"]:
-                terminal_idx.append(idx)
-                terminal_obs.append(inf["terminal_observation"])
-        if len(terminal_obs) > 0:
-            terminal_obs = _unflatten_obs(self.obs_normalizer(_flatten_obs(terminal_obs)))
-
-        # collect the true next states and masks (accounting for time truncation)
-        true_next_obs = _unflatten_obs(next_obs)
-        true_mask = mask.copy()
-        for idx, term_ob in zip(terminal_idx, terminal_obs):
-            true_next_obs[idx] = term_ob
-            true_mask[idx] = 1.0
-        true_next_obs = _flatten_obs(true_next_obs)
+        trunc_mask = np.fromiter(
+            (inf.get("terminal_info", {}).get("TimeLimit.truncated", False) for inf in info["n"]),
+            dtype=bool, count=len(info["n"]))
+        terminal_idx = np.flatnonzero(trunc_mask)
+
+        # collect the true next states and masks (accounting for time truncation),
+        # the next obs only needs a copy if any sub-env got truncated
+        if len(terminal_idx) > 0:
+            terminal_obs = [info["n"][idx]["terminal_observation"] for idx in terminal_idx]
+            mask[trunc_mask] = 1.0
+            true_mask = mask
+            if self._is_box_obs:
+                true_next_obs = next_obs.copy()
+                true_next_obs[trunc_mask] = self.obs_normalizer(np.stack(terminal_obs))
+            else:
+                true_next_obs = _unflatten_obs(next_obs)
+                terminal_obs = _unflatten_obs(self.obs_normalizer(_flatten_obs(terminal_obs)))
+                for idx, term_ob in zip(terminal_idx, terminal_obs):
+                    true_next_obs[idx] = term_ob
+                true_next_obs = _flatten_obs(true_next_obs)
+        else:
+            true_next_obs = next_obs
+            true_mask = mask
 
         self.buffer.push({
             "obs": obs,
@@ -377,7 +493,7 @@ class SafeExplorerDDPG(BaseController):
             "c": c
         })
         obs = next_obs
-        c = np.array([inf["constraint_values"] for inf in info["n"]])
+        c = self._get_constraint_values(self._c_buf)
 
         self.obs = obs
         self.c = c
@@ -385,23 +501,56 @@ class SafeExplorerDDPG(BaseController):
         self.total_steps += self.rollout_batch_size
 
         # learn
-        results = defaultdict(list)
+        results = {}
         if self.total_steps > self.warm_up_steps and not self.total_steps % self.train_interval:
             # Regardless of how long you wait between updates,
             # the ratio of env steps to gradient steps is locked to 1.
             # alternatively, can update once each step
-            for _ in range(self.train_interval):
-                batch = self.buffer.sample(self.train_batch_size, self.device)
-                res = self.agent.update(batch)
-                for k, v in res.items():
-                    results[k].append(v)
+            if self._update_stream is not None:
+                self._update_stream.wait_stream(torch.cuda.current_stream())
+            loss_names = ["policy_loss", "critic_loss"]
+            # no-op context on cpu (stream is None)
+            with torch.cuda.stream(self._update_stream):
+                if self._prefetcher is not None:
+                    batches = self._prefetcher.sample(self.train_interval)
+                else:
+                    batches = (self.buffer.sample(self.train_batch_size, self.device)
+                               for _ in range(self.train_interval))
+                # losses stay on the device, so queuing the updates never waits on the gpu
+                losses = torch.zeros((len(loss_names), self.train_interval), device=self.device)
+                num_updates = 0
+                try:
+                    for batch in batches:
+                        res = self.agent.update(batch)
+                        for i, k in enumerate(loss_names):
+                            losses[i, num_updates] = res[k]
+                        num_updates += 1
+                finally:
+                    # cancel the rest of the prefetched phase right away if an update raised
+                    batches.close()
+                mean_losses = losses[:, :num_updates].mean(dim=1)
+                if self._update_stream is not None:
+                    # copy back without blocking the host, only `log_step` waits for it
+                    host_losses = torch.empty(mean_losses.shape, pin_memory=True)
+                    host_losses.copy_(mean_losses, non_blocking=True)
+                    results["pending_losses"] = (loss_names, host_losses, torch.cuda.current_stream().record_event())
+            if self._update_stream is not None:
+                # later work on the default stream (act, eval, checkpoints) waits on the device
+                # for the updated weights, without blocking the host
+                torch.cuda.current_stream().wait_stream(self._update_stream)
+            else:
+                results.update(zip(loss_names, mean_losses.tolist()))
 
-        results = {k: sum(v) / len(v) for k, v in results.items()}
         results.update({"step": self.total_steps, "elapsed_time": time.time() - start})
         return results
 
     def log_step(self, results):
         """Does logging after a training step."""
+        if "pending_losses" in results:
+            # losses of updates queued on the side stream, synced only now that they are logged
+            loss_names, host_losses, event = results.pop("pending_losses")
+            event.synchronize()
+            results.update(zip(loss_names, host_losses.tolist()))
         step = results["step"]
         final_step = self.constraint_epochs if self.pretraining else self.max_env_steps
 
@@ -434,16 +583,13 @@ class SafeExplorerDDPG(BaseController):
                     step,
                     prefix="loss")
 
-            # performance stats
-            ep_lengths = np.asarray(self.env.length_queue)
-            ep_returns = np.asarray(self.env.return_queue)
-            ep_constraint_violation = np.asarray(self.env.queued_stats["constraint_violation"])
+            # performance stats (running means kept by the stats wrapper)
             self.logger.add_scalars(
                 {
-                    "ep_length": ep_lengths.mean(),
-                    "ep_return": ep_returns.mean(),
-                    "ep_reward": (ep_returns / ep_lengths).mean(),
-                    "ep_constraint_violation": ep_constraint_violation.mean()
+                    "ep_length": self.env.mean("length"),
+                    "ep_return": self.env.mean("return"),
+                    "ep_reward": self.env.mean("reward"),
+                    "ep_constraint_violation": self.env.mean("constraint_violation")
                 },
                 step,
                 prefix="stat")
@@ -482,38 +628,83 @@ class SafeExplorerDDPG(BaseController):
         step = 0
         obs, info = self.env.reset()
         obs = self.obs_normalizer(obs)
-        c = np.array([inf["constraint_values"] for inf in info["n"]])
+        c = self._get_constraint_values(self._c_buf)
         while step < num_steps:
-            action_spaces = self.env.get_attr("action_space")
-            action = np.array([space.sample() for space in action_spaces])
+            action = self._sample_random_actions()
             obs_next, _, done, info = self.env.step(action)
             obs_next = self.obs_normalizer(obs_next)
-            c_next = []
-            for i, d in enumerate(done):
-                if d:
-                    c_next_i = info["n"][i]["terminal_info"]["constraint_values"]
-                else:
-                    c_next_i = info["n"][i]["constraint_values"]
-                c_next.append(c_next_i)
-            c_next = np.array(c_next)
+            c_next = self._get_constraint_values(self._c_next_buf, info["n"], done)
             self.constraint_buffer.push({"act": action, "obs": obs, "c": c, "c_next": c_next})
             obs = obs_next
-            c = np.array([inf["constraint_values"] for inf in info["n"]])
+            c = self._get_constraint_values(self._c_buf)
             step += self.rollout_batch_size
 
+    def _to_device_tensor(self,
+                          x,
+                          staging=None
+                          ):
+        """Converts a numpy batch to a float32 tensor on the agent device.
+
+        With a pinned `staging` tensor, the batch is cast into it in one copy and sent
+        with a non-blocking transfer; otherwise float32 inputs are wrapped without a copy.
+
+        """
+        if staging is None:
+            return torch.as_tensor(x, dtype=torch.float32, device=self.device)
+        np.copyto(staging.numpy(), x)
+        return staging.to(self.device, non_blocking=True)
+
+    def _sample_random_actions(self):
+        """Samples uniformly random actions for all sub-envs at once.
+
+        """
+        if not self._act_bounded:
+            return np.stack([self.env.action_space.sample() for _ in range(self.rollout_batch_size)])
+        return self._rng.uniform(self._act_low, self._act_high, size=self._act_shape).astype(np.float32, copy=False)
+
+    def _get_constraint_values(self,
+                               out,
+                               infos=None,
+                               done=None
+                               ):
+        """Copies the latest constraint values gathered by the env wrapper into the preallocated `out`.
+
+        If `done` is given, finished sub-envs take their terminal constraint values from `infos` instead.
+
+        """
+        np.copyto(out, self.env.get_info_buffer("constraint_values"))
+        if done is not None:
+            for i in np.flatnonzero(done):
+                out[i] = infos[i]["terminal_info"]["constraint_values"]
+        return out
+
     def eval_constraint_models(self):
         """Runs evaluation for the constraint models.
 
         """
-        eval_resutls = defaultdict(list)
         self.safety_layer.eval()
         self.obs_normalizer.set_read_only()
         # Collect evaluation data.
         self.collect_constraint_data(self.constraint_eval_steps)
+        eval_resutls = self._make_constraint_loss_buffers()
+        num_batches = 0
         for batch in self.constraint_buffer.sampler(self.constraint_batch_size):
             losses = self.safety_layer.compute_loss(batch)
             for i, loss in enumerate(losses):
-                eval_resutls["constraint_{}_loss".format(i)].append(loss.item())
+                eval_resutls["constraint_{}_loss".format(i)][num_batches] = loss.item()
+            num_batches += 1
         self.constraint_buffer.reset()
-        eval_resutls = {k: sum(v) / len(v) for k, v in eval_resutls.items()}
+        eval_resutls = {k: float(v[:num_batches].mean()) for k, v in eval_resutls.items() if num_batches > 0}
         return eval_resutls
+
+    def _make_constraint_loss_buffers(self):
+        """Preallocates per-batch loss arrays for one pass over the constraint buffer.
+
+        Callers average only the entries they filled, the size is just an upper bound.
+
+        """
+        num_batches = -(-len(self.constraint_buffer) // self.constraint_batch_size)
+        return {
+            "constraint_{}_loss".format(i): np.zeros(num_batches, dtype=np.float32)
+            for i in range(self.safety_layer.num_constraints)
+        }
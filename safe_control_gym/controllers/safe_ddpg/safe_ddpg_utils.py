@@ -1,10 +1,13 @@
+import os
+import queue
+import threading
 from collections import defaultdict
 from copy import deepcopy
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from gym.spaces import Box, Discrete
+from gymnasium.spaces import Box, Discrete
 
 from safe_control_gym.math_and_models.distributions import Normal, Categorical
 from safe_control_gym.math_and_models.neural_networks import MLP, CNN, RNN, init_
@@ -107,7 +110,10 @@ class SafeDDPGAgent:
         return critic_loss
 
     def update(self, batch):
-        """Updates model parameters based on current training batch."""
+        """Updates model parameters based on current training batch.
+
+        Losses are returned as detached tensors on the device, so the caller decides when to sync.
+        """
         resutls = defaultdict(list)
 
         # actor update
@@ -125,8 +131,8 @@ class SafeDDPGAgent:
         # update target networks
         soft_update(self.ac, self.ac_targ, self.tau)
 
-        resutls["policy_loss"] = policy_loss.item()
-        resutls["critic_loss"] = critic_loss.item()
+        resutls["policy_loss"] = policy_loss.detach()
+        resutls["critic_loss"] = critic_loss.detach()
         return resutls
 
 
@@ -235,13 +241,19 @@ class SafeDDPGBuffer(SACBuffer):
     Attributes:
         max_size (int): maximum size of the replay buffer.
         batch_size (int): number of samples (steps) per batch.
+        store_device (str): if given, device to hold the storage as torch tensors,
+            otherwise the storage is kept as numpy arrays.
+        obs_dtype (str|np.dtype): storage precision of observations and constraint values,
+            sampled batches are always cast back to float32.
         scheme (dict): describs shape & other info of data to be stored.
         keys (list): names of all data from scheme.
     """
 
-    def __init__(self, obs_space, act_space, max_size, batch_size=None):
+    def __init__(self, obs_space, act_space, max_size, batch_size=None, store_device=None, obs_dtype=np.float32):
         self.max_size = max_size
         self.batch_size = batch_size
+        self.store_device = store_device
+        self.obs_dtype = obs_dtype
 
         obs_dim = obs_space.shape
         act_dim = act_space.shape[0]
@@ -249,10 +261,12 @@ class SafeDDPGBuffer(SACBuffer):
         N = max_size
         self.scheme = {
             "obs": {
-                "vshape": (N, *obs_dim)
+                "vshape": (N, *obs_dim),
+                "dtype": obs_dtype
             },
             "next_obs": {
-                "vshape": (N, *obs_dim)
+                "vshape": (N, *obs_dim),
+                "dtype": obs_dtype
             },
             "act": {
                 "vshape": (N, act_dim)
@@ -265,19 +279,199 @@ class SafeDDPGBuffer(SACBuffer):
                 "init": np.ones
             },
             "c": {	
-                "vshape": (N, 1) # otherwise compile error
+                "vshape": (N, 1), # otherwise compile error
+                "dtype": obs_dtype
             }
         }
         self.keys = list(self.scheme.keys())
         self.reset()
 
+    def reset(self):
+        """Allocate space for containers."""
+        super().reset()
+        if self.store_device is not None:
+            for k in self.keys:
+                self.__dict__[k] = torch.as_tensor(self.__dict__[k], device=self.store_device)
+
+    def state_dict(self, path=None):
+        """Returns a snapshot of current buffer.
+
+        If `path` is given, the filled part of each field is written to `<path>.<key>.npy`
+        and only the file names are kept in the snapshot (no large arrays to pickle).
+        """
+        if path is None:
+            return super().state_dict()
+        state = dict(
+            pos=self.pos,
+            buffer_size=self.buffer_size,
+            files={}
+        )
+        for k in self.keys:
+            v = self.__dict__[k][:self.buffer_size]
+            if self.store_device is not None:
+                v = v.cpu().numpy()
+            file_name = "{}.{}.npy".format(path, k)
+            np.save(file_name, v)
+            state["files"][k] = os.path.basename(file_name)
+        return state
+
+    def load_state_dict(self, state, path=None):
+        """Restores buffer from previous state.
+
+        Fields saved to files are memory-mapped and copied into the preallocated storage,
+        the files are looked up next to `path`. Snapshots holding the arrays themselves
+        (from `state_dict()` without a path) are copied in the same way.
+        """
+        self.pos = state["pos"]
+        self.buffer_size = state["buffer_size"]
+        if "files" in state:
+            path_dir = os.path.dirname(path) if path else ""
+            fields = {k: np.load(os.path.join(path_dir, file_name), mmap_mode="r")
+                      for k, file_name in state["files"].items()}
+        else:
+            fields = {k: state[k] for k in self.keys}
+        for k, v in fields.items():
+            if self.store_device is not None and not torch.is_tensor(v):
+                v = torch.from_numpy(np.array(v))
+            self.__dict__[k][:len(v)] = v
+
+    def push(self, batch):
+        """Inserts transition step data (as dict) to storage."""
+        # batch size
+        k = list(batch.keys())[0]
+        n = batch[k].shape[0]
+
+        for k, v in batch.items():
+            shape = self.scheme[k]["vshape"][1:]
+            dtype = self.scheme[k].get("dtype", np.float32)
+            v_ = np.asarray(v, dtype=dtype).reshape((n,) + shape)
+            if self.store_device is not None:
+                # one host-to-device copy per field
+                v_ = torch.from_numpy(v_).to(self.store_device)
+
+            if self.pos + n <= self.max_size:
+                self.__dict__[k][self.pos:self.pos + n] = v_
+            else:
+                # wrap around
+                remain_n = self.pos + n - self.max_size
+                self.__dict__[k][self.pos:self.max_size] = v_[:-remain_n]
+                self.__dict__[k][:remain_n] = v_[-remain_n:]
+
+        if self.buffer_size < self.max_size:
+            self.buffer_size = min(self.max_size, self.pos + n)
+        self.pos = (self.pos + n) % self.max_size
+
+    def sample(self, batch_size=None, device=None):
+        """Returns data batch.
+
+        Fancy indexing into the preallocated storage already yields fresh contiguous
+        copies, so numpy ones are wrapped with `torch.from_numpy` without another copy.
+        Batches gathered on cpu are pinned for an asynchronous transfer when sampling to cuda.
+        """
+        if not batch_size:
+            batch_size = self.batch_size
+
+        if self.store_device is None:
+            indices = np.random.randint(0, len(self), size=batch_size)
+        else:
+            indices = torch.randint(0, len(self), (batch_size,), device=self.store_device)
+        pin = device is not None and torch.device(device).type == "cuda"
+        batch = {}
+        for k in self.keys:
+            v = self.__dict__[k][indices]
+            if self.store_device is None:
+                v = torch.from_numpy(v)
+            if pin and v.device.type == "cpu":
+                v = v.pin_memory()
+            if device is not None:
+                v = v.to(device, non_blocking=pin)
+            # reduced precision storage is cast back after the transfer (no-op for float32)
+            batch[k] = v.float()
+        return batch
+
+
+class PrefetchSampler:
+    """Samples replay batches in a background thread, ahead of the updates consuming them.
+
+    One long-lived worker serves every update phase: `sample(num_batches)` asks it for a
+    phase worth of batches, of which up to `depth` are prepared in advance, including their
+    transfer to `device` (issued on `stream` for cuda), so sampling overlaps with the gradient steps.
+    """
+
+    # Marks the end of a phase in the batch queue.
+    _DONE = (None, None)
+
+    def __init__(self, buffer, batch_size, device, depth=2, stream=None):
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.device = device
+        self.stream = stream
+        self.requests = queue.Queue()
+        self.queue = queue.Queue(maxsize=depth)
+        self.cancel = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            num_batches = self.requests.get()
+            if num_batches is None:
+                return
+            try:
+                for _ in range(num_batches):
+                    if self.cancel.is_set():
+                        break
+                    # no-op context on cpu (stream is None)
+                    with torch.cuda.stream(self.stream):
+                        batch = self.buffer.sample(self.batch_size, self.device)
+                    event = self.stream.record_event() if self.stream is not None else None
+                    self.queue.put((batch, event))
+            except Exception as e:
+                self.queue.put((e, None))
+            self.queue.put(self._DONE)
+
+    def sample(self, num_batches):
+        """Yields `num_batches` batches sampled by the worker."""
+        if self.stream is not None:
+            # storage on cuda may still be written by pending pushes
+            self.stream.wait_stream(torch.cuda.current_stream())
+        self.requests.put(num_batches)
+        try:
+            for _ in range(num_batches):
+                batch, event = self.queue.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                if event is not None:
+                    stream = torch.cuda.current_stream()
+                    stream.wait_event(event)
+                    # tensors allocated on the side stream are now also used on this one
+                    for v in batch.values():
+                        v.record_stream(stream)
+                yield batch
+        finally:
+            # also reached when the consumer exits early (e.g. on an exception),
+            # the worker then skips the rest of the phase
+            self.cancel.set()
+            while self.queue.get() is not self._DONE:
+                pass
+            self.cancel.clear()
+
+    def close(self):
+        """Stops the background thread."""
+        self.requests.put(None)
+        self.thread.join()
+
 
 # -----------------------------------------------------------------------------------
 #                   Misc
 # -----------------------------------------------------------------------------------
 
-def make_action_noise_process(noise_config, act_space):
+def make_action_noise_process(noise_config, act_space, num_envs=None):
     """Construct a process for generating action noise during agent training.
+
+    If `num_envs` is given, the process keeps an independent state per env and
+    each `sample()` returns a (num_envs, act_dim) batch in one call. The std
+    schedule still advances once per env, as with num_envs separate samples.
     """
     process_func = noise_config.pop("func")
     std_config = noise_config.pop("std")
@@ -286,5 +480,5 @@ def make_action_noise_process(noise_config, act_space):
     std_args = std_config.pop("args")
     std = eval(std_func)(std_args, **std_config) # Todo: verify this change
 
-    process = eval(process_func)(size=(act_space.shape[0],), std=std)
+    process = eval(process_func)(size=(act_space.shape[0],), std=std, num_envs=num_envs)
     return process
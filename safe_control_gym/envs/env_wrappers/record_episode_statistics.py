@@ -106,10 +106,16 @@ class VecRecordEpisodeStatistics(VecEnvWrapper):
         self.episode_length = np.zeros(self.num_envs)
         self.return_queue = deque(maxlen=deque_size)
         self.length_queue = deque(maxlen=deque_size)
+        # Per-step rewards (return / length) of the queued episodes.
+        self.reward_queue = deque(maxlen=deque_size)
         # Other tracked stats.
         self.episode_stats = {}
         self.accumulated_stats = {}
         self.queued_stats = {}
+        # Running sum of each queue, updated on append/evict.
+        self.queue_sums = {}
+        # Preallocated per-env arrays gathered from the infos.
+        self.info_buffers = {}
 
     def add_tracker(self,
                     name,
@@ -122,9 +128,61 @@ class VecRecordEpisodeStatistics(VecEnvWrapper):
             self.accumulated_stats[name] = init_value
         elif mode == 'queue':
             self.queued_stats[name] = deque(maxlen=self.deque_size)
+            # A (re-)added queue starts empty, so its running sum restarts too.
+            self.queue_sums[name] = 0.0
         else:
             raise Exception('Tracker mode not implemented.')
 
+    def mean(self,
+             name
+             ):
+        '''Returns the mean over a queue (length|return|reward or a queued tracker) in O(1).'''
+        n = len(self._get_queue(name))
+        if n == 0:
+            return np.nan
+        return self.queue_sums[name] / n
+
+    def _get_queue(self,
+                   name
+                   ):
+        if name == 'length':
+            return self.length_queue
+        if name == 'return':
+            return self.return_queue
+        if name == 'reward':
+            return self.reward_queue
+        return self.queued_stats[name]
+
+    def _append_to_queue(self,
+                         name,
+                         value
+                         ):
+        '''Appends to a queue and updates its running sum, removing the evicted value if full.'''
+        queue = self._get_queue(name)
+        total = self.queue_sums.get(name, 0.0)
+        if queue.maxlen is not None and len(queue) == queue.maxlen:
+            total = total - queue[0]
+        queue.append(value)
+        self.queue_sums[name] = total + value
+
+    def add_info_buffer(self,
+                        name,
+                        shape=(),
+                        dtype=np.float32
+                        ):
+        '''Adds a preallocated array filled with an info entry from every env on reset and step.
+
+        The array is overwritten in place on each reset/step, copy it if needed beyond that.
+        '''
+        self.info_buffers[name] = np.zeros((self.num_envs,) + tuple(shape), dtype=dtype)
+        return self.info_buffers[name]
+
+    def get_info_buffer(self,
+                        name
+                        ):
+        '''Returns the preallocated array of an info entry for the latest reset/step.'''
+        return self.info_buffers[name]
+
     def reset(self,
               **kwargs
               ):
@@ -134,13 +192,20 @@ class VecRecordEpisodeStatistics(VecEnvWrapper):
         for key in self.episode_stats:
             for i in range(self.num_envs):
                 self.episode_stats[key][i] *= 0
-        return self.venv.reset(**kwargs)
+        obs, info = self.venv.reset(**kwargs)
+        for key, buf in self.info_buffers.items():
+            for i, inf in enumerate(info['n']):
+                buf[i] = inf[key]
+        return obs, info
 
     def step_wait(self):
         obs, reward, done, info = self.venv.step_wait()
         for i, (r, d) in enumerate(zip(reward, done)):
             self.episode_return[i] += r
             self.episode_length[i] += 1
+            # Gather info entries (from the reset info if the env is done).
+            for key, buf in self.info_buffers.items():
+                buf[i] = info['n'][i][key]
             # Add other tracked stats.
             for key in self.episode_stats:
                 if d:
@@ -151,8 +216,9 @@ class VecRecordEpisodeStatistics(VecEnvWrapper):
                     self.episode_stats[key][i] += inf[key]
             if d:
                 info['n'][i]['episode'] = {'r': self.episode_return[i], 'l': self.episode_length[i]}
-                self.return_queue.append(deepcopy(self.episode_return[i]))
-                self.length_queue.append(deepcopy(self.episode_length[i]))
+                self._append_to_queue('return', deepcopy(self.episode_return[i]))
+                self._append_to_queue('length', deepcopy(self.episode_length[i]))
+                self._append_to_queue('reward', self.episode_return[i] / self.episode_length[i])
                 self.episode_return[i] = 0
                 self.episode_length[i] = 0
                 # Other tracked stats.
@@ -161,6 +227,6 @@ class VecRecordEpisodeStatistics(VecEnvWrapper):
                     if key in self.accumulated_stats:
                         self.accumulated_stats[key] += deepcopy(self.episode_stats[key][i])
                     if key in self.queued_stats:
-                        self.queued_stats[key].append(deepcopy(self.episode_stats[key][i]))
+                        self._append_to_queue(key, deepcopy(self.episode_stats[key][i]))
                     self.episode_stats[key][i] *= 0
         return obs, reward, done, info
@@ -7,6 +7,7 @@ See also:
 
 import copy
 import multiprocessing as mp
+import pickle
 
 import numpy as np
 
@@ -108,7 +109,7 @@ class SubprocVecEnv(VecEnv):
 
     def get_attr(self, attr_name, indices=None):
         '''Return attribute from vectorized environment (see base class).'''
-        target_remotes, remote_env_indices = self._get_target_envs(indices)
+        target_remotes, remote_env_indices, _ = self._get_target_envs(indices)
         for remote, env_indices in zip(target_remotes, remote_env_indices):
             remote.send(('get_attr', (env_indices, attr_name)))
         return _flatten_list([remote.recv() for remote in target_remotes])
@@ -140,11 +141,11 @@ class SubprocVecEnv(VecEnv):
         for i in range(len(splits) - 1):
             start, end = splits[i], splits[i + 1]
             if method_args is None:
-                method_arg_splits.append([[]] * len(end - start))
+                method_arg_splits.append([[]] * (end - start))
             else:
                 method_arg_splits.append(method_args[start:end])
             if method_kwargs is None:
-                method_kwarg_splits.append([{}] * len(end - start))
+                method_kwarg_splits.append([{}] * (end - start))
             else:
                 method_kwarg_splits.append(method_kwargs[start:end])
 
@@ -163,20 +164,21 @@ class SubprocVecEnv(VecEnv):
             remote_envs: [0,1], [2,3], [4,5]
             target_envs: [1,1,3,4]
 
-            remote_indices: [0,0,1,1] -> [0,1]
-            splits: [0,2] -> [0,2,4]
-            remote_env_indices: [1,1,0,1] -> [1,1], [0,1]
+            remote_indices: [0,0,1,2] -> [0,1,2]
+            splits: [0,2,3] -> [0,2,3,4]
+            remote_env_indices: [1,1,1,0] -> [1,1], [1], [0]
         '''
 
         assert indices is None or sorted(
             indices) == indices, 'Indices must be ordered'
         indices = self._get_indices(indices)
-        remote_indices = [idx // self.n_workers for idx in indices]
-        remote_env_indices = [idx % self.n_workers for idx in indices]
+        n_envs_per_worker = self.num_envs // self.n_workers
+        remote_indices = [idx // n_envs_per_worker for idx in indices]
+        remote_env_indices = [idx % n_envs_per_worker for idx in indices]
         remote_indices, splits = np.unique(np.array(remote_indices), return_index=True)
         target_remotes = [self.remotes[idx] for idx in remote_indices]
         remote_env_indices = np.split(np.array(remote_env_indices), splits[1:])
-        remote_env_indices = remote_env_indices.tolist()
+        remote_env_indices = [env_indices.tolist() for env_indices in remote_env_indices]
         splits = np.append(splits, [len(indices)])
         return target_remotes, remote_env_indices, splits
 
@@ -188,10 +190,13 @@ def worker(remote, parent_remote, env_fn_wrappers):
         if done:
             end_obs = copy.deepcopy(ob)
             end_info = copy.deepcopy(info)
-            ob, info = env.reset()
+            ob, info = reset_env(env)
             info['terminal_observation'] = end_obs
             info['terminal_info'] = end_info
         return ob, reward, done, info
+    def reset_env(env):
+        ob, info = env.reset()
+        return ob, _picklable_info(info)
     parent_remote.close()
     envs = [env_fn_wrapper() for env_fn_wrapper in env_fn_wrappers.x]
     try:
@@ -202,7 +207,7 @@ def worker(remote, parent_remote, env_fn_wrappers):
                 remote.send(
                     [step_env(env, action) for env, action in zip(envs, data)])
             elif cmd == 'reset':
-                remote.send([env.reset() for env in envs])
+                remote.send([reset_env(env) for env in envs])
             elif cmd == 'render':
                 remote.send([env.render(mode='rgb_array') for env in envs])
             elif cmd == 'close':
@@ -247,3 +252,15 @@ def worker(remote, parent_remote, env_fn_wrappers):
     finally:
         for env in envs:
             env.close()
+
+
+def _picklable_info(info):
+    '''Drops info entries that cannot be sent through a pipe (e.g. casadi symbolic models on reset).'''
+    picklable = {}
+    for key, value in info.items():
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+        picklable[key] = value
+    return picklable
@@ -19,26 +19,31 @@ class RandomProcess(object):
 
 
 class GaussianProcess(RandomProcess):
-    def __init__(self, size, std):
-        self.size = size
+    def __init__(self, size, std, num_envs=None):
+        # with `num_envs`, each sample is a (num_envs, *size) batch, one independent draw per env
+        self.size = size if num_envs is None else (num_envs,) + tuple(size)
         self.std = std
+        self.std_steps = 1 if num_envs is None else num_envs
 
     def sample(self):
-        return np.random.randn(*self.size) * self.std()
+        return np.random.randn(*self.size) * self.std(self.std_steps)
 
 
 class OrnsteinUhlenbeckProcess(RandomProcess):
-    def __init__(self, size, std, theta=.15, dt=1e-2, x0=None):
+    def __init__(self, size, std, theta=.15, dt=1e-2, x0=None, num_envs=None):
         self.theta = theta
         self.mu = 0
         self.std = std
         self.dt = dt
         self.x0 = x0
-        self.size = size
+        # with `num_envs`, each sample is a (num_envs, *size) batch, one independent state per env
+        self.size = size if num_envs is None else (num_envs,) + tuple(size)
+        # a batched sample counts as num_envs steps of the std schedule
+        self.std_steps = 1 if num_envs is None else num_envs
         self.reset_states()
 
     def sample(self):
-        x = self.x_prev + self.theta * (self.mu - self.x_prev) * self.dt + self.std() * np.sqrt(
+        x = self.x_prev + self.theta * (self.mu - self.x_prev) * self.dt + self.std(self.std_steps) * np.sqrt(
             self.dt) * np.random.randn(*self.size)
         self.x_prev = x
         return x
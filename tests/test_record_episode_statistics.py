@@ -0,0 +1,28 @@
+from functools import partial
+
+import numpy as np
+
+from safe_control_gym.envs.env_wrappers.record_episode_statistics import VecRecordEpisodeStatistics
+from safe_control_gym.envs.env_wrappers.vectorized_env import make_vec_envs
+from safe_control_gym.utils.registration import make
+
+
+def test_vec_queue_mean():
+    '''Checks the running queue means against np.mean over the (evicting) deques.'''
+    env = make_vec_envs(partial(make, 'cartpole'), None, 2, 1, 0)
+    env = VecRecordEpisodeStatistics(env, deque_size=5)
+    assert np.isnan(env.mean('return'))
+    values = np.random.rand(12) * 100
+    for v in values:
+        env._append_to_queue('return', v)
+    assert np.isclose(env.mean('return'), np.mean(env.return_queue))
+    assert np.isclose(env.mean('return'), np.mean(values[-5:]))
+    # A re-added queue tracker starts from scratch.
+    env.add_tracker('constraint_violation', 0, mode='queue')
+    for v in values:
+        env._append_to_queue('constraint_violation', v)
+    env.add_tracker('constraint_violation', 0, mode='queue')
+    for v in values[:3]:
+        env._append_to_queue('constraint_violation', v)
+    assert np.isclose(env.mean('constraint_violation'), np.mean(values[:3]))
+    env.close()
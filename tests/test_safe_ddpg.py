@@ -0,0 +1,78 @@
+import os
+from functools import partial
+
+import numpy as np
+import pytest
+import torch
+from gymnasium.spaces import Box
+
+from safe_control_gym.controllers.safe_ddpg.safe_ddpg_utils import SafeDDPGBuffer
+from safe_control_gym.utils.registration import get_config, make
+
+
+def test_safe_ddpg_subproc(tmp_path):
+    '''Trains safe DDPG on cartpole with subprocess envs (num_workers > 1).'''
+    env_func = partial(make,
+                       'cartpole',
+                       info_in_reset=True,
+                       episode_len_sec=0.5,
+                       done_on_violation=False,
+                       constraints=[{'constraint_form': 'linear_constraint',
+                                     'constrained_variable': 'state',
+                                     'A': [[0, 0, 1, 0]],
+                                     'b': [0.16]}])
+    config = get_config('safe_explorer_ddpg')
+    config.update(num_workers=2,
+                  rollout_batch_size=4,
+                  constraint_slack=0.05,
+                  constraint_steps_per_epoch=200,
+                  constraint_eval_steps=100,
+                  constraint_batch_size=32,
+                  constraint_buffer_size=1000,
+                  max_buffer_size=1000,
+                  warm_up_steps=40,
+                  train_interval=20,
+                  train_batch_size=16)
+    # Pre-train the safety layer.
+    pretrained = os.path.join(tmp_path, 'pretrain', 'model_latest.pt')
+    ctrl = make('safe_explorer_ddpg', env_func, training=True, output_dir=os.path.join(tmp_path, 'pretrain'), **config)
+    ctrl.reset()
+    ctrl.pretrain_step()
+    ctrl.save(pretrained)
+    ctrl.close()
+    # Train the policy, stepping past the warm-up and through several updates (with episode resets).
+    config.update(pretraining=False, pretrained=pretrained)
+    ctrl = make('safe_explorer_ddpg', env_func, training=True, output_dir=os.path.join(tmp_path, 'train'), **config)
+    ctrl.reset()
+    for _ in range(30):
+        results = ctrl.train_step()
+    ctrl.close()
+    assert results['step'] == 120
+    assert len(ctrl.buffer) == 120
+    assert 'policy_loss' in results and 'critic_loss' in results
+
+
+@pytest.mark.parametrize('store_device', [None, 'cpu'])
+@pytest.mark.parametrize('to_files', [True, False])
+def test_safe_ddpg_buffer_state_dict(tmp_path, store_device, to_files):
+    '''Restores a wrapped-around replay buffer from .npy files and from an in-memory (older) snapshot.'''
+    obs_space, act_space = Box(-1, 1, (3,)), Box(-1, 1, (2,))
+    # In-memory snapshots come from numpy storage, as in checkpoints saved before the .npy format.
+    buffer = SafeDDPGBuffer(obs_space, act_space, 10, store_device=store_device if to_files else None)
+    for n in [7, 6]:
+        buffer.push({'obs': np.random.rand(n, 3),
+                     'act': np.random.rand(n, 2),
+                     'rew': np.random.rand(n),
+                     'next_obs': np.random.rand(n, 3),
+                     'mask': np.random.rand(n),
+                     'c': np.random.rand(n, 1)})
+    assert buffer.pos == 3 and len(buffer) == 10
+    path = os.path.join(tmp_path, 'model_latest.pt')
+    state = buffer.state_dict(path) if to_files else buffer.state_dict()
+
+    restored = SafeDDPGBuffer(obs_space, act_space, 10, store_device=store_device)
+    restored.load_state_dict(state, path)
+    assert restored.pos == buffer.pos and len(restored) == len(buffer)
+    for k in buffer.keys:
+        assert torch.is_tensor(restored.__dict__[k]) == (store_device is not None)
+        assert np.array_equal(np.asarray(restored.__dict__[k]), np.asarray(buffer.__dict__[k]))